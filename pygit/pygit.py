@@ -1,16 +1,43 @@
 import argparse
+import binascii
+import bisect
+import concurrent.futures
+import dataclasses
 import sys
 import os
 import hashlib
 import zlib
 import enum
+import mmap
 import stat
 import collections
 import struct
-import difflib
+import threading
 
 from pathlib import Path
 
+try:
+    # C-accelerated patience diff, same interface as difflib.unified_diff
+    from patiencediff import unified_diff
+except ImportError:
+    from difflib import unified_diff
+
+try:
+    # libdeflate is about twice as fast as zlib for one-shot (de)compression
+    import libdeflate
+
+    deflate_compressor = libdeflate.Compressor(1)
+    deflate_decompressor = libdeflate.Decompressor()
+    # Fail here rather than on first use if the API is not the expected one
+    deflate_compressor.compress_zlib, deflate_decompressor.decompress_zlib
+except (ImportError, AttributeError, TypeError):
+    # Not installed, or some other module of that name with a different API
+    libdeflate = None
+
+
+# Size of the slices large blobs are streamed in when compressing/hashing
+CHUNK_SIZE = 1 << 20
+
 
 class ObjectType(enum.Enum):
     commit = 1
@@ -18,25 +45,28 @@ class ObjectType(enum.Enum):
     blob = 3
 
 
+# Binary layout of the git index header and of the fixed-size part of each
+# index entry, compiled once
+INDEX_HEADER_STRUCT = struct.Struct("!4sLL")
+INDEX_ENTRY_STRUCT = struct.Struct("!LLLLLLLLLL20sH")
+
+
 # Data for one entry in the git index (.git/index)
-IndexEntry = collections.namedtuple(
-    "IndexEntry",
-    [
-        "ctime_s",
-        "ctime_n",
-        "mtime_s",
-        "mtime_n",
-        "dev",
-        "ino",
-        "mode",
-        "uid",
-        "gid",
-        "size",
-        "sha1",
-        "flags",
-        "path",
-    ],
-)
+@dataclasses.dataclass(slots=True)
+class IndexEntry:
+    ctime_s: int
+    ctime_n: int
+    mtime_s: int
+    mtime_n: int
+    dev: int
+    ino: int
+    mode: int
+    uid: int
+    gid: int
+    size: int
+    sha1: bytes
+    flags: int
+    path: str
 
 
 def read_file(path: str) -> bytes:
@@ -49,6 +79,47 @@ def write_file(path: str, data: bytes):
         f.write(data)
 
 
+def write_compressed(path: str, header: bytes, data: bytes):
+    """Zlib-compress header followed by data into path, atomically via a
+    temporary file that is hard-linked into place."""
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".tmp.{os.getpid()}.{threading.get_ident()}"
+    )
+    renamed = False
+    try:
+        with open(tmp_path, "wb") as f:
+            # libdeflate compresses in one shot from a concatenated copy, so
+            # only use it for small objects; stream large ones through zlib
+            if libdeflate is not None and len(data) < CHUNK_SIZE:
+                f.write(deflate_compressor.compress_zlib(header + data))
+            else:
+                co = zlib.compressobj(level=1)
+                f.write(co.compress(header))
+                view = memoryview(data)
+                for i in range(0, len(view), CHUNK_SIZE):
+                    f.write(co.compress(view[i : i + CHUNK_SIZE]))
+                f.write(co.flush())
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            # Already stored, maybe written concurrently by another process
+            pass
+        except OSError:
+            # No hard links on this filesystem (vfat, some network mounts):
+            # rename into place instead, like git's finalize_object_file
+            os.replace(tmp_path, path)
+            renamed = True
+    finally:
+        if not renamed:
+            os.unlink(tmp_path)
+
+
+def write_lines(lines: list[str]):
+    """Write lines to stdout with a single write call."""
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+
+
 def init(repo: str):
     """Create directory for repo and initialize .git directory."""
     Path(repo).mkdir()
@@ -65,27 +136,70 @@ def hash_object(data: str, obj_type: str, write: bool = True) -> str:
     """Compute has of object data of given type and write to object store
     if "write" is True. Return SHA-1 object has as hex string
     """
-    header = f"{obj_type} {len(data)}".encode()
-    full_data = header + b"\x00" + data
-    sha1 = hashlib.sha1(full_data).hexdigest()
+    return hash_object_raw(data, obj_type, write=write).hex()
+
+
+def hash_object_raw(data: bytes, obj_type: str, write: bool = True) -> bytes:
+    """Same as hash_object, but return SHA-1 object hash as raw 20 bytes."""
+    header = f"{obj_type} {len(data)}".encode() + b"\x00"
+    h = hashlib.new("sha1", usedforsecurity=False)
+    h.update(header)
+    h.update(data)
+    sha1 = h.digest()
     if write:
-        path = os.path.join(".git", "objects", sha1[:2], sha1[2:])
-        if not os.path.exists(path):
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            write_file(path, zlib.compress(full_data))
+        sha1_hex = sha1.hex()
+        bucket_name, name = sha1_hex[:2], sha1_hex[2:]
+        bucket = object_buckets.get(bucket_name)
+        i = bisect.bisect_left(bucket, name) if bucket is not None else 0
+        if bucket is None or i == len(bucket) or bucket[i] != name:
+            obj_dir = os.path.join(".git", "objects", bucket_name)
+            if obj_dir not in created_object_dirs:
+                os.makedirs(obj_dir, exist_ok=True)
+                created_object_dirs.add(obj_dir)
+            write_compressed(os.path.join(obj_dir, name), header, data)
+            if bucket is not None:
+                bucket.insert(i, name)
     return sha1
 
 
-def find_object(sha1_prefix: str) -> str:
-    """Find object with given SHA-1 prefix and return path to object in object store,
-    or raise ValueError if there are no objects or multiple objects with this prefix
+# Sorted object file names of each .git/objects/XX directory, loaded on
+# first lookup and kept up to date by hash_object_raw
+object_buckets: dict[str, list[str]] = {}
+
+# Object directories already created (or found to exist) by hash_object_raw
+created_object_dirs: set[str] = set()
+
+
+def load_object_bucket(bucket_name: str) -> list[str]:
+    """Return sorted names of objects in .git/objects/<bucket_name>."""
+    bucket = object_buckets.get(bucket_name)
+    if bucket is None:
+        try:
+            with os.scandir(os.path.join(".git", "objects", bucket_name)) as it:
+                bucket = sorted(entry.name for entry in it)
+        except FileNotFoundError:
+            bucket = []
+        object_buckets[bucket_name] = bucket
+    return bucket
+
+
+def find_object(sha1_prefix: str | bytes) -> str:
+    """Find object with given SHA-1 prefix (hex string or raw bytes) and return path
+    to object in object store, or raise ValueError if there are no objects or
+    multiple objects with this prefix
     """
+    if isinstance(sha1_prefix, bytes):
+        sha1_prefix = sha1_prefix.hex()
     if len(sha1_prefix) < 2:
         raise ValueError("hash prefix must be 2 or more characters")
 
     obj_dir = os.path.join(".git", "objects", sha1_prefix[:2])
     rest = sha1_prefix[2:]
-    objects = [name for name in os.listdir(obj_dir) if name.startswith(rest)]
+    bucket = load_object_bucket(sha1_prefix[:2])
+    start = end = bisect.bisect_left(bucket, rest)
+    while end < len(bucket) and bucket[end].startswith(rest):
+        end += 1
+    objects = bucket[start:end]
     if not objects:
         raise ValueError(f"object {sha1_prefix} not found")
     if len(objects) >= 2:
@@ -94,19 +208,85 @@ def find_object(sha1_prefix: str) -> str:
     return os.path.join(obj_dir, objects[0])
 
 
-def read_object(sha1_prefix: str) -> tuple[str, bytes]:
+class ObjectCache:
+    """LRU cache of decompressed (object_type, data) tuples keyed by full
+    SHA-1, bounded by number of entries and by total size of cached data."""
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, sha1: str):
+        obj = self.entries.get(sha1)
+        if obj is not None:
+            self.entries.move_to_end(sha1)
+        return obj
+
+    def put(self, sha1: str, obj: tuple[str, bytes]):
+        size = len(obj[1])
+        if size > self.max_bytes or sha1 in self.entries:
+            return
+        self.entries[sha1] = obj
+        self.total_bytes += size
+        while (
+            len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            _, (_, data) = self.entries.popitem(last=False)
+            self.total_bytes -= len(data)
+
+
+object_cache = ObjectCache()
+
+
+def read_object(sha1_prefix: str | bytes) -> tuple[str, bytes]:
     """Read object with given SHA-1 prefix and return tuple of
     (object_tyoe, data_byetes), or raise ValueError if not found.
+    A raw bytes SHA-1 is always complete, so it is read without a lookup.
     """
+    if isinstance(sha1_prefix, bytes):
+        return read_object_by_sha(sha1_prefix.hex())
     path = find_object(sha1_prefix)
-    full_data = zlib.decompress(read_file(path))
-    nul_index = full_data.index(b"\x00")
-    header = full_data[:nul_index]
+    return read_object_by_sha(sha1_prefix[:2] + os.path.basename(path))
+
+
+def read_object_by_sha(sha1: str) -> tuple[str, bytes]:
+    """Read object with given full SHA-1, going through object_cache so
+    repeated reads of the same object are only decompressed once."""
+    obj = object_cache.get(sha1)
+    if obj is not None:
+        return obj
+
+    path = os.path.join(".git", "objects", sha1[:2], sha1[2:])
+    # Decompress just enough to parse the header, then inflate the data with
+    # its size known up front instead of growing a buffer for header + data
+    try:
+        compressed = read_file(path)
+    except FileNotFoundError:
+        raise ValueError(f"object {sha1} not found") from None
+    dco = zlib.decompressobj()
+    head = dco.decompress(compressed, 64)
+    nul_index = head.index(b"\x00")
+    header = head[:nul_index]
     obj_type, size_str = header.decode().split()
     size = int(size_str)
-    data = full_data[nul_index + 1 :]
-    if size != len(data):
-        raise ValueError(f"expected size {size}, but got {len(data)} bytes")
+    if libdeflate is not None:
+        # libdeflate needs the exact output size, which the header gives us
+        full_data = deflate_decompressor.decompress_zlib(
+            compressed, nul_index + 1 + size
+        )
+        data = full_data[nul_index + 1 :]
+        if size != len(data):
+            raise ValueError(f"expected size {size}, but got {len(data)} bytes")
+    else:
+        data = head[nul_index + 1 :]
+        if len(data) <= size:
+            # Allow one byte more than expected so oversized objects get detected
+            data += dco.decompress(dco.unconsumed_tail, size - len(data) + 1)
+        if size != len(data) or not dco.eof:
+            raise ValueError(f"expected size {size}, but got {len(data)} bytes")
+    object_cache.put(sha1, (obj_type, data))
     return (obj_type, data)
 
 
@@ -140,30 +320,51 @@ def cat_file(mode: str, sha1_prefix: str):
         raise ValueError("unexpected mode {!r}".format(mode))
 
 
+def scan_index_offsets(data, start: int, end: int) -> tuple[list[int], list[int]]:
+    """Walk the variable-length index entries in data[start:end] and return
+    tuple of (entry_start_offsets, path_end_offsets)."""
+    starts = []
+    path_ends = []
+    find = data.find
+    limit = end - 62
+    i = start
+    while i < limit:
+        path_end = find(b"\x00", i + 62, end)
+        assert path_end >= 0, f"unterminated path in index entry at {i}"
+        starts.append(i)
+        path_ends.append(path_end)
+        # 62 bytes of fields plus path, NUL-padded to a multiple of 8
+        i += (path_end - i + 8) & ~7
+    return starts, path_ends
+
+
 def read_index() -> list[IndexEntry]:
     """Read git index file and return list of IndexEntry objects."""
     try:
-        data = read_file(os.path.join(".git", "index"))
+        f = open(os.path.join(".git", "index"), "rb")
     except FileNotFoundError:
         return []
 
-    digest = hashlib.sha1(data[:-20]).digest()
-    assert digest == data[-20:], "invalid index checksum"
-    signature, version, num_entries = struct.unpack("!4sLL", data[:12])
-    assert signature == b"DIRC", f"invalid index signature {signature}"
-    assert version == 2, f"unkown index version {version}"
-    entry_data = data[12:-20]
-    entries = []
-    i = 0
-    while i + 62 < len(entry_data):
-        fields_end = i + 62
-        fields = struct.unpack("!LLLLLLLLLL20sH", entry_data[i:fields_end])
-        path_end = entry_data.index(b"\x00", fields_end)
-        path = entry_data[fields_end:path_end]
-        entry = IndexEntry(*(fields + (path.decode(),)))
-        entries.append(entry)
-        entry_len = ((62 + len(path) + 8) // 8) * 8
-        i += entry_len
+    # Work on a read-only mapping of the index so neither hashing nor parsing
+    # needs to copy the whole file
+    with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm)[:-20] as body:
+            digest = hashlib.new("sha1", body, usedforsecurity=False).digest()
+        assert digest == mm[-20:], "invalid index checksum"
+        signature, version, num_entries = INDEX_HEADER_STRUCT.unpack_from(mm, 0)
+        assert signature == b"DIRC", f"invalid index signature {signature}"
+        assert version == 2, f"unkown index version {version}"
+
+        # Entries are variable-length because of the trailing path, so first
+        # find where each one starts and where its NUL-terminated path ends
+        starts, path_ends = scan_index_offsets(mm, 12, len(mm) - 20)
+
+        # Then unpack the fixed-size fields of each entry in place
+        unpack_entry = INDEX_ENTRY_STRUCT.unpack_from
+        entries = [
+            IndexEntry(*unpack_entry(mm, i), mm[i + 62 : path_end].decode())
+            for i, path_end in zip(starts, path_ends)
+        ]
     assert len(entries) == num_entries
     return entries
 
@@ -171,35 +372,143 @@ def read_index() -> list[IndexEntry]:
 def ls_files(details: bool = False):
     """Print list of files in index (including mode,
     SHA-1 and stage number if "details" is True"""
-    for entry in read_index():
-        if details:
-            stage = (entry.flags >> 12) & 3
-            print(f"{entry.mode} {entry.sha1.hex()} {stage} {entry.path}")
-        else:
-            print(entry.path)
+    entries = read_index()
+    if details:
+        # Hex-encode all SHA-1s in one call rather than one .hex() per entry
+        hexes = binascii.hexlify(b"".join(e.sha1 for e in entries)).decode()
+        lines = [
+            f"{e.mode} {hexes[i * 40 : i * 40 + 40]} {(e.flags >> 12) & 3} {e.path}"
+            for i, e in enumerate(entries)
+        ]
+    else:
+        lines = [e.path for e in entries]
+    write_lines(lines)
+
+
+def open_for_hashing(path: str) -> int:
+    """Open file at path for reading and return file descriptor, without
+    updating its access time where the OS allows it (O_NOATIME is Linux-only
+    and refused for files we don't own, in which case we open normally).
+    """
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    noatime = getattr(os, "O_NOATIME", 0)
+    if noatime:
+        try:
+            return os.open(path, flags | noatime)
+        except PermissionError:
+            pass
+    return os.open(path, flags)
+
+
+# Per-thread read buffer reused for every file hashed by hash_blob_file
+hash_buffers = threading.local()
+
+
+def hash_blob_file(path: str, size: int) -> tuple[str, bytes]:
+    """Compute blob SHA-1 of file at path (of given size, as already known
+    from stat) without loading it whole, return tuple of (path, raw 20-byte
+    digest). Safe to call from worker threads as hashlib and file reads
+    release the GIL.
+    """
+    buf = getattr(hash_buffers, "buf", None)
+    if buf is None:
+        buf = hash_buffers.buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    h = hashlib.new("sha1", b"blob %d\x00" % size, usedforsecurity=False)
+    with open(open_for_hashing(path), "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while n := f.readinto(buf):
+            h.update(view[:n])
+        if hasattr(os, "posix_fadvise"):
+            # Each file is read only once, don't let it crowd the page cache
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return (path, h.digest())
+
+
+def mode_from_stat(st_mode: int) -> int:
+    """Normalize st_mode to the mode git stores in the index (like git's
+    ce_mode_from_stat): symlink, executable file or regular file."""
+    if stat.S_ISLNK(st_mode):
+        return 0o120000
+    return 0o100755 if st_mode & 0o100 else 0o100644
+
+
+def stat_matches(entry: IndexEntry, st: os.stat_result, index_mtime_ns: int) -> bool:
+    """Return True if stat data of a working file matches its index entry, in
+    which case the file is assumed unchanged without hashing it (like git's
+    ce_match_stat). Entries not older than the index file itself are "racily
+    clean" and never trusted, as a write in the same tick could be missed.
+    """
+    mtime_ns = entry.mtime_s * 1_000_000_000 + entry.mtime_n
+    if mtime_ns >= index_mtime_ns:
+        return False
+    return (
+        entry.mtime_s == (st.st_mtime_ns // 1_000_000_000) & 0xFFFFFFFF
+        and entry.mtime_n == st.st_mtime_ns % 1_000_000_000
+        and entry.ctime_s == (st.st_ctime_ns // 1_000_000_000) & 0xFFFFFFFF
+        and entry.ctime_n == st.st_ctime_ns % 1_000_000_000
+        and entry.size == st.st_size & 0xFFFFFFFF
+        and entry.ino == st.st_ino & 0xFFFFFFFF
+        and entry.dev == st.st_dev & 0xFFFFFFFF
+        and entry.mode == mode_from_stat(st.st_mode)
+    )
+
+
+def walk_working_tree(dir_path: str, prefix: str, out: dict[str, os.DirEntry]):
+    """Recursively collect files under dir_path (skipping .git) into out,
+    keyed by "/"-separated path relative to the top of the working copy.
+    DirEntry objects are kept so their cached stat() can be reused.
+    Unreadable directories are skipped, as os.walk does.
+    """
+    try:
+        it = os.scandir(dir_path)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            if entry.name == ".git":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                walk_working_tree(entry.path, prefix + entry.name + "/", out)
+            elif not entry.is_dir():
+                out[prefix + entry.name] = entry
 
 
 def get_status() -> tuple[set, set, set]:
     """Get status of working copy, return tuple of (changed_path,
     new_paths, deleted_paths)"""
-    paths = set()
-    for root, dirs, files in os.walk("."):
-        dirs[:] = [d for d in dirs if d != ".git"]
-        for file in files:
-            path = os.path.join(root, file)
-            path = path.replace("\\", "/")
-            if path.startswith("./"):
-                path = path[2:]
-            paths.add(path)
+    files = {}
+    walk_working_tree(".", "", files)
+    paths = set(files)
     entries_by_path = {e.path: e for e in read_index()}
     entry_paths = set(entries_by_path)
-
-    changed = {
-        p
-        for p in (paths & entry_paths)
-        if hash_object(read_file(p), "blob", write=False)
-        != entries_by_path[p].sha1.hex()
-    }
+    try:
+        index_mtime_ns = os.stat(os.path.join(".git", "index")).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime_ns = 0
+
+    # Only hash files whose stat data doesn't match their index entry,
+    # keeping their sizes and index SHA-1s as columns parallel to to_hash
+    to_hash = []
+    sizes = []
+    index_sha1s = []
+    for p in paths & entry_paths:
+        entry = entries_by_path[p]
+        st = files[p].stat()
+        if not stat_matches(entry, st, index_mtime_ns):
+            to_hash.append(p)
+            sizes.append(st.st_size)
+            index_sha1s.append(entry.sha1)
+    changed = set()
+    if to_hash:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            results = ex.map(hash_blob_file, to_hash, sizes)
+            changed = {
+                p
+                for (p, sha1), index_sha1 in zip(results, index_sha1s)
+                if sha1 != index_sha1
+            }
     new = paths - entry_paths
     deleted = entry_paths - paths
 
@@ -209,18 +518,16 @@ def get_status() -> tuple[set, set, set]:
 def status():
     """Show status of working copy."""
     changed, new, deleted = get_status()
-    if changed:
-        print("changed files:")
-        for path in changed:
-            print("   ", path)
-    if new:
-        print("new files:")
-        for path in new:
-            print("   ", path)
-    if deleted:
-        print("deleted files:")
-        for path in deleted:
-            print("   ", path)
+    lines = []
+    for title, paths in [
+        ("changed files:", changed),
+        ("new files:", new),
+        ("deleted files:", deleted),
+    ]:
+        if paths:
+            lines.append(title)
+            lines.extend("    " + path for path in paths)
+    write_lines(lines)
 
 
 def diff():
@@ -228,12 +535,11 @@ def diff():
     changed, _, _ = get_status()
     entries_by_path = {e.path: e for e in read_index()}
     for i, path in enumerate(changed):
-        sha1 = entries_by_path[path].sha1.hex()
-        obj_type, data = read_object(sha1)
+        obj_type, data = read_object(entries_by_path[path].sha1)
         assert obj_type == "blob"
         index_lines = data.decode().splitlines()
         working_lines = read_file(path).decode().splitlines()
-        diff_lines = difflib.unified_diff(
+        diff_lines = unified_diff(
             index_lines, working_lines, f"{path} (index)", f"{path} (working copy)"
         )
         for line in diff_lines:
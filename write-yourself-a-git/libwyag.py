@@ -2,11 +2,29 @@ import re
 import os
 import sys
 import argparse
+import bisect
+import concurrent.futures
 import configparser
 import zlib
 import hashlib
+import mmap
+import stat
+import threading
 import collections
 
+try:
+    # Use OpenSSL's SHA-1 directly: it uses the CPU's SHA extensions where
+    # available, unlike the builtin fallback hashlib may otherwise pick
+    from _hashlib import openssl_sha1 as new_sha1
+except ImportError:
+    new_sha1 = hashlib.sha1
+
+# Size of the slices large objects are streamed in
+CHUNK_SIZE = 1 << 20
+
+# Parsed config files: gitdir -> (config mtime, ConfigParser)
+config_cache = dict()
+
 argparser = argparse.ArgumentParser(description="The stupidest content tracker")
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
 argsubparsers.required = True
@@ -15,36 +33,10 @@ argsubparsers.required = True
 def main(argv=sys.argv[1:]):
     args = argparser.parse_args(argv)
 
-    if args.command == "add":
-        cmd_add(args)
-    elif args.command == "cat-file":
-        cmd_cat_file(args)
-    elif args.command == "checkout":
-        cmd_checkout(args)
-    elif args.command == "commit":
-        cmd_commit(args)
-    elif args.command == "hash-object":
-        cmd_hash_object(args)
-    elif args.command == "init":
-        cmd_init(args)
-    elif args.command == "log":
-        cmd_log(args)
-    elif args.command == "ls-files":
-        cmd_ls_files(args)
-    elif args.command == "ls-tree":
-        cmd_ls_tree(args)
-    elif args.command == "merge":
-        cmd_merge(args)
-    elif args.command == "rebase":
-        cmd_rebase(args)
-    elif args.command == "rev-parse":
-        cmd_rev_parse(args)
-    elif args.command == "rm":
-        cmd_rm(args)
-    elif args.command == "show-ref":
-        cmd_show_ref(args)
-    elif args.command == "tag":
-        cmd_tag(args)
+    command = commands.get(args.command)
+    if command is None:
+        raise Exception(f"Unknown command {args.command}")
+    command(args)
 
 
 """
@@ -58,28 +50,62 @@ class GitRepository(object):
     worktree = None
     gitdir = None
     conf = None
+    object_cache = None
+    objects_dir = None
+    object_dirs = None
+    object_listings = None
+    compression = None
 
     def __init__(self, path, force=False) -> None:
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
+        self.objects_dir = os.path.join(self.gitdir, "objects")
+        # objects/XX directories known to exist, listed on the first write
+        self.object_dirs = None
+        # objects/XX directory -> sorted names of the objects it holds
+        self.object_listings = dict()
+        self.object_cache = ObjectCache()
 
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception(f"Not a Git repository {path}")
 
         # Read configuration file
-        self.conf = configparser.ConfigParser()
         cf = repo_file(self, "config")
 
         if cf and os.path.exists(cf):
-            self.conf.read([cf])
+            self.conf = repo_config(self.gitdir, cf)
         elif not force:
             raise Exception("Configuration file missing")
+        else:
+            self.conf = configparser.ConfigParser()
 
         if not force:
             vers = int(self.conf.get("core", "repositoryformatversion"))
             if vers != 0:
                 raise Exception(f"Unsupported respositoryformatversion {vers}")
 
+        # zlib level for loose objects. Like git, core.looseCompression
+        # wins over core.compression, but we default to the fast level 1
+        self.compression = self.conf.getint(
+            "core",
+            "loosecompression",
+            fallback=self.conf.getint("core", "compression", fallback=1),
+        )
+
+
+def repo_config(gitdir, cf):
+    """Parse the config file cf of gitdir, reusing the previous parse
+    while the file's mtime is unchanged"""
+    mtime = os.stat(cf).st_mtime_ns
+    cached = config_cache.get(gitdir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    conf = configparser.ConfigParser()
+    conf.read([cf])
+    config_cache[gitdir] = (mtime, conf)
+    return conf
+
 
 # utility functions to compute those paths and create missing directroy structures if needed
 def repo_path(repo: GitRepository, *path):
@@ -114,6 +140,41 @@ def repo_dir(repo: GitRepository, *path, mkdir=False):
         return None
 
 
+def repo_object_path(repo: GitRepository, sha, mkdir=False):
+    """
+    Compute path of loose object sha, like repo_file(repo, "objects",
+    sha[0:2], sha[2:]) but without the generic path joining. If mkdir,
+    create its directory if missing; the existing directories are listed
+    once per repository instance, so this is a set lookup.
+    """
+    prefix = sha[0:2]
+    if mkdir and repo.object_dirs is None:
+        try:
+            repo.object_dirs = set(os.listdir(repo.objects_dir))
+        except FileNotFoundError:
+            repo.object_dirs = set()
+    if mkdir and prefix not in repo.object_dirs:
+        os.makedirs(os.path.join(repo.objects_dir, prefix), exist_ok=True)
+        repo.object_dirs.add(prefix)
+    return f"{repo.objects_dir}{os.sep}{prefix}{os.sep}{sha[2:]}"
+
+
+def repo_object_listing(repo: GitRepository, prefix):
+    """
+    Return sorted names of the loose objects in objects/<prefix>. The
+    directory is only listed once per repository instance.
+    """
+    listing = repo.object_listings.get(prefix)
+    if listing is None:
+        try:
+            with os.scandir(os.path.join(repo.objects_dir, prefix)) as it:
+                listing = sorted(entry.name for entry in it)
+        except FileNotFoundError:
+            listing = list()
+        repo.object_listings[prefix] = listing
+    return listing
+
+
 def repo_create(path):
     """
     Create a new repository at path.
@@ -164,21 +225,23 @@ def repo_default_config():
 
 
 def repo_find(path=".", required=True):
+    # Resolve once: parents of a real path are real paths too
     path = os.path.realpath(path)
-    if os.path.isdir(os.path.join(path, ".git")):
-        return GitRepository(path)
 
-    # If we haven't return, recurse in parent
-    parent = os.path.realpath(os.path.join(path, ".."))
+    while True:
+        if os.path.isdir(os.path.join(path, ".git")):
+            return GitRepository(path)
 
-    if parent == path:
-        if required:
-            raise Exception("No git directory")
-        else:
-            return None
+        # If we haven't return, walk up to the parent
+        parent = os.path.dirname(path)
 
-    # Recursive case
-    return repo_find(parent, required)
+        if parent == path:
+            if required:
+                raise Exception("No git directory")
+            else:
+                return None
+
+        path = parent
 
 
 argsp = argsubparsers.add_parser("init", help="Initialize a new. empty repository")
@@ -222,15 +285,67 @@ class GitObject(object):
         raise Exception("Unimplemented!")
 
 
+class ObjectCache(object):
+    """
+    LRU cache of the objects read from a repository, keyed by SHA.
+    Bounded both by number of objects and by their total raw size.
+    """
+
+    def __init__(self, max_objects=4096, max_bytes=64 << 20) -> None:
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.objects = collections.OrderedDict()
+        self.size = 0
+        # object_read may be called from several threads (tree_checkout)
+        self.lock = threading.Lock()
+
+    def get(self, sha):
+        with self.lock:
+            entry = self.objects.get(sha)
+            if entry is None:
+                return None
+            self.objects.move_to_end(sha)
+            return entry[0]
+
+    def get_header(self, sha):
+        """Return (fmt, size) of a cached object, or None if not cached"""
+        with self.lock:
+            entry = self.objects.get(sha)
+            if entry is None:
+                return None
+            return entry[0].fmt, entry[1]
+
+    def put(self, sha, obj, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if sha in self.objects:
+                return
+            self.objects[sha] = (obj, size)
+            self.size += size
+            while len(self.objects) > self.max_objects or self.size > self.max_bytes:
+                _, (_, old_size) = self.objects.popitem(last=False)
+                self.size -= old_size
+
+
 def object_read(repo, sha):
     """
     Read object object_id from Git repository repo.
     Return a GitObject whose exact type depends on the object.
+    Objects are cached on the repository, so callers must not modify them.
     """
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        return obj
 
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    path = repo_object_path(repo, sha)
+
+    # zlib reads the mapped pages directly, without copying the
+    # compressed file into memory first
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        raw = zlib.decompress(mm)
 
         # Read object type
         x = raw.find(b" ")
@@ -238,7 +353,7 @@ def object_read(repo, sha):
 
         # Read and validate object size
         y = raw.find(b"\x00", x)
-        size = int(raw[x:y].decode("ascii"))
+        size = int(raw[x:y])
         if size != len(raw) - y - 1:
             raise Exception(f"Malformed object {sha}: bad length")
 
@@ -254,7 +369,35 @@ def object_read(repo, sha):
         else:
             raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
 
-        return c(repo, raw[y + 1 :])
+        obj = c(repo, raw[y + 1 :])
+        repo.object_cache.put(sha, obj, size)
+        return obj
+
+
+def object_read_header(repo, sha):
+    """
+    Read only the header of object sha from Git repository repo.
+    Return its (fmt, size), decompressing no more than needed to get them.
+    """
+    # Objects we already read fully don't need to be touched again
+    header = repo.object_cache.get_header(sha)
+    if header is not None:
+        return header
+
+    path = repo_object_path(repo, sha)
+
+    with open(path, "rb") as f:
+        dco = zlib.decompressobj()
+        head = b""
+        while b"\x00" not in head:
+            chunk = dco.unconsumed_tail or f.read(64)
+            if not chunk:
+                raise Exception(f"Malformed object {sha}: missing header")
+            head += dco.decompress(chunk, 64)
+
+    x = head.find(b" ")
+    y = head.find(b"\x00", x)
+    return head[0:x], int(head[x:y])
 
 
 def object_find(repo, name, fmt=None, follow=True):
@@ -276,19 +419,21 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
+        # The header is enough to check the type, no need to decompress
+        # the whole object (which may be a huge blob)
+        obj_fmt, _ = object_read_header(repo, sha)
 
-        if obj.fmt == fmt:
+        if obj_fmt == fmt:
             return sha
 
         if not follow:
             return None
 
         # Follow tags
-        if obj.fmt == b"tag":
-            sha = obj.kvlm[b"object"].decode("ascii")
-        elif obj.fmt == b"commit" and fmt == b"tree":
-            sha = obj.kvlm[b"tree"].decode("ascii")
+        if obj_fmt == b"tag":
+            sha = object_read(repo, sha).kvlm[b"object"].decode("ascii")
+        elif obj_fmt == b"commit" and fmt == b"tree":
+            sha = object_read(repo, sha).kvlm[b"tree"].decode("ascii")
         else:
             return None
 
@@ -296,22 +441,42 @@ def object_find(repo, name, fmt=None, follow=True):
 def object_write(obj, actually_write=True):
     # Serialize object data
     data = obj.serialize()
-    # Add header
-    result = obj.fmt + b" " + str(len(data)).encode() + b"\x00" + data
-    # Compute hash
-    sha = hashlib.sha1(result).hexdigest()
+    # Build header
+    header = obj.fmt + b" " + str(len(data)).encode() + b"\x00"
+    # Compute hash, feeding header and data separately so they
+    # never have to be concatenated
+    h = new_sha1()
+    h.update(header)
+    h.update(data)
+    sha = h.hexdigest()
 
     if actually_write:
         # Compute path
-        path = repo_file(obj.repo, "objects", sha[0:2], sha[2:], mkdir=actually_write)
+        path = repo_object_path(obj.repo, sha, mkdir=actually_write)
 
         with open(path, "wb") as f:
-            # Compress and write
-            f.write(zlib.compress(result))
+            # Compress and write, streaming data through the compressor
+            co = zlib.compressobj(level=obj.repo.compression)
+            f.write(co.compress(header))
+            mv = memoryview(data)
+            for i in range(0, len(mv), CHUNK_SIZE):
+                f.write(co.compress(mv[i : i + CHUNK_SIZE]))
+            f.write(co.flush())
+
+        repo_object_listing_add(obj.repo, sha)
 
     return sha
 
 
+def repo_object_listing_add(repo, sha):
+    """Keep an already loaded listing of sha's objects/XX directory up to date"""
+    listing = repo.object_listings.get(sha[0:2])
+    if listing is not None:
+        i = bisect.bisect_left(listing, sha[2:])
+        if i == len(listing) or listing[i] != sha[2:]:
+            listing.insert(i, sha[2:])
+
+
 class GitBlob(GitObject):
     fmt = b"blob"
 
@@ -364,7 +529,7 @@ argsp.add_argument(
     help="Actually write the object into the database",
 )
 
-argsp.add_argument("path", help="Read object from <file>")
+argsp.add_argument("path", nargs="+", help="Read object from <file>")
 
 
 def cmd_hash_object(args):
@@ -373,12 +538,18 @@ def cmd_hash_object(args):
     else:
         repo = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        print(sha)
+    if len(args.path) == 1:
+        with open(args.path[0], "rb") as fd:
+            print(object_hash(fd, args.type.encode(), repo))
+    else:
+        for sha in object_hash_many(args.path, args.type.encode(), repo):
+            print(sha)
 
 
 def object_hash(fd, fmt, repo=None):
+    if fmt == b"blob":
+        return fast_hash_blob(fd, repo, repo is not None)
+
     data = fd.read()
 
     # Choose constructor depending on
@@ -389,74 +560,152 @@ def object_hash(fd, fmt, repo=None):
         obj = GitTree(repo, data)
     elif fmt == b"tag":
         obj = GitTag(repo, data)
-    elif fmt == b"blob":
-        obj = GitBlob(repo, data)
     else:
         raise Exception("Unknown type %s!" % fmt)
 
     return object_write(obj, repo)
 
 
+# Per-thread read buffer of fast_hash_blob, reused across calls
+hash_buffers = threading.local()
+
+
+def fast_hash_blob(fd, repo, write):
+    """Hash the regular file fd as a blob in a single streaming pass:
+    each chunk read is fed to SHA-1 and, if write is set, to the
+    compressor, whose output goes to a temporary file that is renamed
+    into place once the SHA-1 is known. Anything but a regular file (a
+    pipe, /dev/stdin, an in-memory stream...) has no size up front and is
+    read whole instead."""
+    try:
+        st = os.fstat(fd.fileno())
+    except (AttributeError, OSError):
+        # No file descriptor (io.UnsupportedOperation is an OSError)
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return object_write(GitBlob(repo, fd.read()), write)
+
+    size = st.st_size
+    header = b"blob " + str(size).encode() + b"\x00"
+    h = new_sha1()
+    h.update(header)
+
+    f = None
+    try:
+        if write:
+            tmp = os.path.join(
+                repo.objects_dir, f"tmp_obj_{os.getpid()}_{threading.get_ident()}"
+            )
+            f = open(tmp, "wb")
+            co = zlib.compressobj(level=repo.compression)
+            f.write(co.compress(header))
+
+        buf = getattr(hash_buffers, "buf", None)
+        if buf is None:
+            buf = hash_buffers.buf = bytearray(CHUNK_SIZE)
+        mv = memoryview(buf)
+        total = 0
+        while n := fd.readinto(buf):
+            total += n
+            h.update(mv[:n])
+            if write:
+                f.write(co.compress(mv[:n]))
+        if total != size:
+            raise Exception(f"{fd.name} changed while being hashed")
+        if write:
+            f.write(co.flush())
+            f.close()
+    except BaseException:
+        if f is not None:
+            f.close()
+            os.unlink(tmp)
+        raise
+
+    sha = h.hexdigest()
+    if write:
+        os.replace(tmp, repo_object_path(repo, sha, mkdir=True))
+        repo_object_listing_add(repo, sha)
+    return sha
+
+
+def object_hash_path(path, fmt, repo=None):
+    """Hash the object read from the file at path"""
+    with open(path, "rb") as fd:
+        return object_hash(fd, fmt, repo)
+
+
+def object_hash_many(paths, fmt, repo=None):
+    """Hash the objects read from each of paths on a thread pool (SHA-1,
+    zlib and file I/O all release the GIL), returning SHA-1s in order."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        return list(ex.map(lambda path: object_hash_path(path, fmt, repo), paths))
+
+
 """
 5. Reading commit history: log
 """
 
 
+# A newline that isn't followed by a continuation line ends a KVLM value
+KVLM_VALUE_END_RE = re.compile(rb"\n(?! )")
+
+
 # KVLM: Key-Vakye List with Message
 def kvlm_parse(raw: str, start=0, dct=None):
     if not dct:
-        dct = collections.OrderedDict()
-        # You CANNOT declare the argument as dct=OrderedDict() or all
+        # Plain dicts keep insertion order, which serialization relies on
+        dct = dict()
+        # You CANNOT declare the argument as dct=dict() or all
         # call the functions will endlessly grow the same dict.
 
-    # We search for the next space and the next newline
-    spc = raw.find(b" ", start)
-    nl = raw.find(b"\n", start)
-
-    # If space appears before newline, we have a keyword
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1). we assume a blank line. A black line
-    # means the remainder of the data is the message
-
-    if spc < 0 or nl < spc:
-        assert nl == start
-        dct[b""] = raw[start + 1 :]
-        return dct
-
-    # Recursive case
-    # =========
-    # we read a key-value pair and recurse for the next
-    key = raw[start:spc]
-
-    # Find the end of the value. Continuation lines begin with a
-    # space. so we loop until we find a "\n" not followed by a space.
-    end = start
+    # Read one key-value pair per iteration until we reach the message
     while True:
-        end = raw.find(b"\n", end + 1)
-        if raw[end + 1] != ord(" "):
-            break
-
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[spc + 1 : end].replace(b"\n ", b"\n")
-
-    # Don't overwrite existing data contents
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+        # We search for the next space and the next newline
+        spc = raw.find(b" ", start)
+        nl = raw.find(b"\n", start)
+
+        # If space appears before newline, we have a keyword
+
+        # Final case
+        # =========
+        # If newline appears first (or there's no space at all, in which
+        # case find returns -1). we assume a blank line. A black line
+        # means the remainder of the data is the message
+
+        if spc < 0 or nl < spc:
+            assert nl == start
+            dct[b""] = raw[start + 1 :]
+            return dct
+
+        # Loop case
+        # =========
+        # we read a key-value pair and continue with the next
+        key = raw[start:spc]
+
+        # Find the end of the value. Continuation lines begin with a
+        # space. so we search for the first "\n" not followed by a space.
+        end = KVLM_VALUE_END_RE.search(raw, start).start()
+
+        # Grab the value
+        # Also, drop the leading space on continuation lines
+        value = raw[spc + 1 : end].replace(b"\n ", b"\n")
+
+        # Don't overwrite existing data contents
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [dct[key], value]
         else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = value
+            dct[key] = value
 
-    return kvlm_parse(raw, start=end + 1, dct=dct)
+        start = end + 1
 
 
 def kvlm_serialize(kvlm: dict):
-    ret = b""
+    # Collect the pieces and join them once at the end, so the cost
+    # stays linear in the output size
+    parts = list()
 
     # Output fields
     for k, val in kvlm.items():
@@ -467,12 +716,16 @@ def kvlm_serialize(kvlm: dict):
         if type(val) != list:
             val = [val]
         for v in val:
-            ret += k + b" " + (v.replace(b"\n", b"\n ")) + b"\n"
+            parts.append(k)
+            parts.append(b" ")
+            parts.append(v.replace(b"\n", b"\n "))
+            parts.append(b"\n")
 
     # Append message
-    ret += b"\n" + kvlm[b""]
+    parts.append(b"\n")
+    parts.append(kvlm[b""])
 
-    return ret
+    return b"".join(parts)
 
 
 class GitCommit(GitObject):
@@ -496,25 +749,31 @@ def cmd_log(args):
 
 
 def log_graphviz(repo, sha, seen):
-    if sha in seen:
-        return
-    seen.add(sha)
+    # Walk the history breadth-first with an explicit queue, so deep
+    # histories can't exhaust the Python stack
+    queue = collections.deque([sha])
 
-    commit: GitCommit = object_read(repo, sha)
-    assert commit.fmt == b"commit"
+    while queue:
+        sha = queue.popleft()
+        if sha in seen:
+            continue
+        seen.add(sha)
 
-    if b"parent" not in commit.kvlm[b"parent"]:
-        # Base case: the initial commit
-        return
-    parents = commit.kvlm[b"parent"]
+        commit: GitCommit = object_read(repo, sha)
+        assert commit.fmt == b"commit"
 
-    if type(parents) != list:
-        parents = [parents]
+        parents = commit.kvlm.get(b"parent")
+        if parents is None:
+            # The initial commit
+            continue
+
+        if type(parents) != list:
+            parents = [parents]
 
-    for p in parents:
-        p = p.decode("ascii")
-        print(f"c_{sha} -> c_{p}")
-        log_graphviz(repo, p, seen)
+        for p in parents:
+            p = p.decode("ascii")
+            print(f"c_{sha} -> c_{p}")
+            queue.append(p)
 
 
 """
@@ -543,8 +802,8 @@ def tree_parse_one(raw, start=0):
     path = raw[x + 1 : y]
 
     # Read the SHA and convert to an hex string
-    # hex() adds 0x in front we don't want that
-    sha = hex(int.from_bytes(raw[y + 1 : y + 21], "big"))[2:]
+    # (bytes.hex() keeps leading zeros, which going through int doesn't)
+    sha = raw[y + 1 : y + 21].hex()
 
     return y + 21, GitTreeLeaf(mode, path, sha)
 
@@ -562,15 +821,16 @@ def tree_parse(raw):
 
 
 def tree_serialize(obj):
-    ret = b""
+    # A bytearray grows in place, unlike bytes which may be copied on
+    # every +=
+    ret = bytearray()
     for i in obj.items:
         ret += i.mode
         ret += b" "
         ret += i.path
         ret += b"\x00"
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+        ret += bytes.fromhex(i.sha)
+    return bytes(ret)
 
 
 class GitTree(GitObject):
@@ -591,17 +851,21 @@ def cmd_ls_tree(args):
     repo = repo_find()
     obj = object_read(repo, object_find(repo, args.object, fmt=b"tree"))
 
+    lines = list()
     for item in obj.items:
-        print(
+        lines.append(
             "{0} {1} {2}\t{3}".format(
                 "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
                 # Git's ls-tree displays the type
                 # of the object pointed to.  We can do that too :)
-                object_read(repo, item.sha).fmt.decode("ascii"),
+                # Only the header is needed for that, not the whole object
+                object_read_header(repo, item.sha)[0].decode("ascii"),
                 item.sha,
-                item.path.decode("ascii"),
+                os.fsdecode(item.path),
             )
         )
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 argsp = argsubparsers.add_parser(
@@ -636,16 +900,34 @@ def cmd_checkout(args):
 
 
 def tree_checkout(repo, tree, path):
+    # Create the directories first, collecting the blobs to write, then
+    # read and write all blobs on a thread pool
+    blobs = list()
+    tree_checkout_dirs(repo, tree, path, blobs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        for _ in ex.map(lambda blob: blob_checkout(repo, *blob), blobs):
+            pass
+
+
+def tree_checkout_dirs(repo, tree, path, blobs):
     for item in tree.items:
-        obj = object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b"tree":
+        # Subtrees always have mode 40000
+        if item.mode == b"40000":
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b"blob":
-            with open(dest, "wb") as f:
-                f.write(obj.blobdata)
+            tree_checkout_dirs(repo, object_read(repo, item.sha), dest, blobs)
+        else:
+            blobs.append((item.sha, dest))
+
+
+def blob_checkout(repo, sha, dest):
+    obj = object_read(repo, sha)
+
+    if obj.fmt == b"blob":
+        with open(dest, "wb") as f:
+            f.write(obj.blobdata)
 
 
 """
@@ -666,10 +948,10 @@ def ref_resolve(repo, ref):
 def ref_list(repo, path=None):
     if not path:
         path = repo_dir(repo, "refs")
-    ret = collections.OrderedDict()
+    ret = dict()
 
-    # Git shows refs sorted. To do the same, we use
-    # an OrderedDict and sort the ouput of listdir
+    # Git shows refs sorted. To do the same, we rely on dicts
+    # keeping insertion order and sort the ouput of listdir
     for f in sorted(os.listdir(path)):
         can = os.path.join(path, f)
         if os.path.isdir(can):
@@ -747,7 +1029,7 @@ def tag_create(repo, name, reference, type):
     if type == "object":
         # create tag object (commit)
         tag = GitTag(repo)
-        tag.kvlm = collections.OrderedDict()
+        tag.kvlm = dict()
         tag.kvlm[b"object"] = sha.encode()
         tag.kvlm[b"type"] = b"commit"
         tag.kvlm[b"tag"] = name.encode()
@@ -799,12 +1081,13 @@ def object_resolve(repo, name):
         # This is a small hash 4 seems to be the minimal length
         name = name.lower()
         prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
+        rem = name[2:]
+        # Names are sorted, so matches are the run starting at rem
+        listing = repo_object_listing(repo, prefix)
+        i = bisect.bisect_left(listing, rem)
+        while i < len(listing) and listing[i].startswith(rem):
+            candidates.append(prefix + listing[i])
+            i += 1
     return candidates
 
 
@@ -835,6 +1118,20 @@ def cmd_rev_parse(args):
     print(object_find(repo, args.name, fmt, follow=True))
 
 
+# Command name -> handler, used by main to dispatch
+commands = {
+    "cat-file": cmd_cat_file,
+    "checkout": cmd_checkout,
+    "hash-object": cmd_hash_object,
+    "init": cmd_init,
+    "log": cmd_log,
+    "ls-tree": cmd_ls_tree,
+    "rev-parse": cmd_rev_parse,
+    "show-ref": cmd_show_ref,
+    "tag": cmd_tag,
+}
+
+
 """
 8. The staging area and the index file
 """